@@ -1,22 +1,33 @@
 import os
 import asyncio
 import logging
+import logging.handlers
+import queue
+import signal
 import sqlite3
 import json
 import re
+import functools
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 from typing import Dict, Optional, List
+import aiohttp
 from aiohttp import web
+from cachetools import TTLCache
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     Message,
     CallbackQuery,
-    FSInputFile,
+    BufferedInputFile,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
     BotCommand,
@@ -31,22 +42,123 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")  # Optional: for AI assistant
 PORT = int(os.getenv("PORT", 10000))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Optional: public base URL, enables webhook mode
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None  # Optional: Telegram echoes it so forged updates are rejected
+DEBUG_SCREENSHOTS = bool(os.getenv("DEBUG_SCREENSHOTS"))  # Optional: send a screenshot when login fails
+CHROMIUM_SINGLE_PROCESS = bool(os.getenv("CHROMIUM_SINGLE_PROCESS"))  # Optional: lowest RSS on tiny hosts, no crash isolation
+BROWSER_CDP_URL = os.getenv("BROWSER_CDP_URL", "")  # Optional: attach to a shared Chromium instead of launching one
+REDIS_URL = os.getenv("REDIS_URL", "")  # Optional: keep FSM state in Redis so it survives restarts
 
 if not BOT_TOKEN:
     raise ValueError("BOT_TOKEN not set")
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-)
+# Handlers only enqueue records; a listener thread does the actual stderr writes.
+_log_queue: queue.SimpleQueue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+_log_enqueue = logging.handlers.QueueHandler(_log_queue)
+_log_enqueue.setFormatter(logging.Formatter("%(message)s"))  # only merge args; the listener adds the prefix
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[_log_enqueue])
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+log_listener.start()
+# aiogram logs every handled update at INFO; keep only its warnings.
+logging.getLogger("aiogram.event").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+def _build_storage():
+    if not REDIS_URL:
+        return MemoryStorage()
+    from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+    # One client (and its connection pool) serves every FSM read/write.
+    return RedisStorage.from_url(REDIS_URL, key_builder=DefaultKeyBuilder(with_bot_id=True))
+
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+storage = _build_storage()
+dp = Dispatcher(storage=storage)
 
+TELEGRAM_RATE_LIMIT = int(os.getenv("TELEGRAM_RATE_LIMIT", 30))  # outgoing Bot API calls per second
 SESSION_TIMEOUT_MINUTES = 30
+SESSION_REAP_INTERVAL = 60  # seconds between sweeps for idle sessions
+SESSION_VERIFY_INTERVAL = 300  # seconds a confirmed login is trusted before the page is re-checked
+SESSION_RECYCLE_AFTER = int(os.getenv("SESSION_RECYCLE_AFTER", 50))  # actions before a session moves to a fresh context
+MAX_CONCURRENT_BROWSERS = int(os.getenv("MAX_CONCURRENT_BROWSERS", 3))  # parallel ERP logins
+MAX_CONCURRENT_SCRAPES = int(os.getenv("MAX_CONCURRENT_SCRAPES", 4))  # parallel ERP page extractions
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 32))  # updates handled at once
+BROWSER_ROTATE_EVERY = int(os.getenv("BROWSER_ROTATE_EVERY", 200))  # contexts before Chromium is relaunched
+MAX_POOLED_PAGES = int(os.getenv("MAX_POOLED_PAGES", MAX_CONCURRENT_BROWSERS))  # idle pages kept warm for reuse
+POOLED_PAGE_MAX_REUSES = 20  # times a page may go back to the pool before its context is replaced
+POOLED_PAGE_IDLE_SECONDS = int(os.getenv("POOLED_PAGE_IDLE_SECONDS", 600))  # close pooled pages unused this long
 ALERT_CHECK_INTERVAL = 3600  # seconds between scheduled alert checks
-user_sessions: Dict[int, Dict] = {}
+SCREENSHOT_JPEG_QUALITY = int(os.getenv("SCREENSHOT_JPEG_QUALITY", 60))  # smaller uploads than PNG
+PAGE_SHOT_CACHE_SECONDS = 60  # re-send a static page's last screenshot instead of reloading it
+LOGIN_STATE_TTL_SECONDS = int(os.getenv("LOGIN_STATE_TTL_SECONDS", 300))  # reuse ERP cookies this long
+MAX_ACTIVE_SESSIONS = int(os.getenv("MAX_ACTIVE_SESSIONS", 100))  # logged-in pages kept open at once
+# chat_id -> session, least recently used first; the bot only serves private chats, so chat == user
+user_sessions: "OrderedDict[int, Dict]" = OrderedDict()
+login_state_cache: TTLCache = TTLCache(maxsize=10_000, ttl=LOGIN_STATE_TTL_SECONDS)  # username -> cookies
+
+# ================= RATE LIMITING =================
+
+# Calls that don't post anything to a chat; Telegram's message limits don't apply to them.
+UNPACED_API_METHODS = {"getUpdates", "answerCallbackQuery"}
+
+class TelegramRateLimiter(BaseRequestMiddleware):
+    """Token bucket in front of outgoing Bot API sends, so bursts are paced instead of hitting RetryAfter."""
+
+    def __init__(self, rate: int = TELEGRAM_RATE_LIMIT):
+        self.rate = rate
+        self._tokens = float(rate)
+        self._updated = 0.0
+        self._lock = asyncio.Lock()
+
+    async def __call__(self, make_request, bot, method):
+        if method.__api_method__ in UNPACED_API_METHODS:
+            return await make_request(bot, method)
+        async with self._lock:
+            now = asyncio.get_running_loop().time()
+            self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens < 1:
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+                self._tokens = 0.0
+                self._updated = asyncio.get_running_loop().time()
+            else:
+                self._tokens -= 1
+        return await make_request(bot, method)
+
+
+bot.session.middleware(TelegramRateLimiter())
+
+
+class UpdateConcurrencyLimiter(BaseMiddleware):
+    """Updates run as separate tasks; cap how many are inside handlers at once so a burst can't pile up work."""
+
+    def __init__(self, limit: int = MAX_CONCURRENT_UPDATES):
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        async with self._semaphore:
+            return await handler(event, data)
+
+
+dp.update.outer_middleware(UpdateConcurrencyLimiter())
+
+# ================= HTTP =================
+
+# One keep-alive pool for the bot's own HTTP calls (ERP page methods, OpenAI), so repeat
+# requests to the same host skip the TCP/TLS handshake. Cookies stay per ClientSession.
+_http_connector: Optional[aiohttp.TCPConnector] = None
+
+def http_session(**kwargs) -> aiohttp.ClientSession:
+    global _http_connector
+    if _http_connector is None or _http_connector.closed:
+        _http_connector = aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75)
+    return aiohttp.ClientSession(connector=_http_connector, connector_owner=False, **kwargs)
+
+async def close_http():
+    if _http_connector is not None:
+        await _http_connector.close()
 
 # ================= STATES =================
 
@@ -97,11 +209,12 @@ def init_db():
     logger.info("Database initialized")
 
 def save_credentials(chat_id: int, username: str, password: str):
+    now = datetime.now().isoformat()
     conn = sqlite3.connect(DB_PATH)
     conn.execute("""
         INSERT OR REPLACE INTO users (chat_id, username, password, created_at, last_login, alerts_on)
         VALUES (?, ?, ?, ?, ?, COALESCE((SELECT alerts_on FROM users WHERE chat_id=?), 1))
-    """, (chat_id, username, password, datetime.now().isoformat(), datetime.now().isoformat(), chat_id))
+    """, (chat_id, username, password, now, now, chat_id))
     conn.commit()
     conn.close()
 
@@ -154,21 +267,110 @@ def log_alert(chat_id: int, alert_type: str, message: str):
 
 # ================= BROWSER =================
 
+# Resource types the login form never needs; skipped while logging in.
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media"}
+
+# Routing a page switches off Chromium's HTTP cache for it, so while lean_loading is active every
+# login and extraction would re-download the ERP's scripts and stylesheets. They're versioned static
+# files, so one process-wide copy serves those requests instead; full loads use the HTTP cache.
+STATIC_ASSET_PATTERN = re.compile(r"^https://noble\.icrp\.in/[^?#]*(\.(css|js)|Resource\.axd)([?#].*)?$", re.IGNORECASE)
+static_asset_cache: TTLCache = TTLCache(maxsize=300, ttl=3600)  # url -> (content type, body)
+
+async def _serve_static_asset(route):
+    url = route.request.url
+    cached = static_asset_cache.get(url)
+    if cached:
+        await route.fulfill(status=200, content_type=cached[0], body=cached[1])
+        return
+    try:
+        response = await route.fetch()
+        body = await response.body()
+    except Exception:
+        await route.fallback()  # let the browser fetch it itself
+        return
+    if response.ok:
+        static_asset_cache[url] = (response.headers.get("content-type", ""), body)
+    await route.fulfill(response=response, body=body)
+
+async def _block_heavy_resources(route):
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+    elif request.method == "GET" and STATIC_ASSET_PATTERN.match(request.url):
+        await _serve_static_asset(route)
+    else:
+        await route.fallback()
+
+# Third-party trackers never affect what we read or screenshot, so Chromium resolves them to nowhere.
+# Done at the resolver rather than with context.route(), which would switch off the HTTP cache
+# for every page in the context, not just while lean_loading is active.
+TRACKER_HOSTS = ("google-analytics.com", "googletagmanager.com", "doubleclick.net",
+                 "facebook.com", "facebook.net", "hotjar.com")
+TRACKER_RESOLVER_RULES = ", ".join(f"MAP {pattern} ~NOTFOUND"
+                                   for host in TRACKER_HOSTS for pattern in (host, f"*.{host}"))
+
 class BrowserManager:
     def __init__(self):
         self.playwright = None
         self.browser: Optional[Browser] = None
-        self.screenshot_counter = 0
+        self._idle_pages: List = []  # (page, parked_at) pairs, most recently parked last
+        self.semaphore = asyncio.Semaphore(MAX_CONCURRENT_BROWSERS)
+        self.scrape_semaphore = asyncio.Semaphore(MAX_CONCURRENT_SCRAPES)
+        self._contexts_served = 0
+        self._ready = asyncio.Event()
+        self._ready.set()
+        self._refill_task: Optional[asyncio.Task] = None
+        self._reuses: Dict = {}  # page -> times it has been released back to the pool
+        self._lean_pages: set = set()  # pages whose current document was loaded with images blocked
+        self._lean_users: Dict = {}  # page -> lean_loading blocks currently active on it
+
+    async def _launch(self):
+        if BROWSER_CDP_URL:
+            # Several bot processes can share one Chromium; each still gets its own contexts.
+            self.browser = await self.playwright.chromium.connect_over_cdp(BROWSER_CDP_URL)
+            self._contexts_served = 0
+            return
+        args = [
+            "--no-sandbox", "--disable-setuid-sandbox", "--disable-dev-shm-usage",
+            # Background services a headless scraper never uses
+            "--disable-background-networking", "--disable-default-apps", "--disable-sync",
+            "--metrics-recording-only", "--no-first-run",
+            # No GPU on the host: skip the GPU process and accelerated canvas/WebGL paths
+            "--disable-gpu", "--disable-accelerated-2d-canvas", "--disable-webgl", "--mute-audio",
+            f"--host-resolver-rules={TRACKER_RESOLVER_RULES}",
+        ]
+        if CHROMIUM_SINGLE_PROCESS:
+            args += ["--single-process", "--no-zygote"]
+        self.browser = await self.playwright.chromium.launch(headless=True, args=args)
+        self._contexts_served = 0
 
     async def start(self):
         self.playwright = await async_playwright().start()
-        self.browser = await self.playwright.chromium.launch(
-            headless=True,
-            args=["--no-sandbox", "--disable-setuid-sandbox", "--disable-dev-shm-usage"],
-        )
+        await self._launch()
+        # Warm the pool in the background so the bot starts taking updates right away;
+        # a login that arrives first simply opens its page inline.
+        self._schedule_top_up()
         logger.info("Browser started")
 
+    async def _rotate(self):
+        """Relaunch Chromium to shed memory it accumulated; only called while no context is in use."""
+        self._ready.clear()
+        try:
+            self._idle_pages.clear()
+            self._reuses.clear()
+            self._lean_pages.clear()
+            await self.browser.close()
+            await self._launch()
+            logger.info("Browser relaunched")
+        finally:
+            self._ready.set()
+
     async def stop(self):
+        if self._refill_task:
+            self._refill_task.cancel()
+        while self._idle_pages:
+            page, _ = self._idle_pages.pop()
+            await self.close_page(page)
         if self.browser:
             await self.browser.close()
         if self.playwright:
@@ -176,16 +378,126 @@ class BrowserManager:
         logger.info("Browser stopped")
 
     async def new_context(self):
-        return await self.browser.new_context(
-            viewport={"width": 1920, "height": 1080},
+        await self._ready.wait()
+        in_use = len(self.browser.contexts) - len(self._idle_pages)
+        if not BROWSER_CDP_URL and self._contexts_served >= BROWSER_ROTATE_EVERY and in_use == 0:
+            await self._rotate()
+        self._contexts_served += 1
+        context = await self.browser.new_context(
+            viewport={"width": 1280, "height": 800},
             user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+            service_workers="block",
         )
+        await context.add_init_script(_JS_AUTO_DISMISS_POPUP)
+        return context
 
-    async def save_screenshot(self, page, prefix="shot"):
-        self.screenshot_counter += 1
-        path = f"/tmp/{prefix}_{self.screenshot_counter}.png"
-        await page.screenshot(path=path, full_page=True)
-        return path
+    async def _top_up(self):
+        """Pre-create contexts + pages, parked on the ERP login form, until the idle pool is full."""
+        try:
+            while len(self._idle_pages) < MAX_POOLED_PAGES:
+                context = await self.new_context()
+                page = await context.new_page()
+                try:
+                    async with self.lean_loading(page):
+                        await page.goto(ERP_LOGIN_URL, wait_until="domcontentloaded")
+                except Exception:
+                    pass  # a blank page is still worth pooling; erp_login navigates it
+                self._idle_pages.append((page, time.monotonic()))
+        except Exception as e:
+            logger.warning("Page pool refill failed: %s", e)
+
+    def _schedule_top_up(self):
+        if self._refill_task is None or self._refill_task.done():
+            self._refill_task = asyncio.create_task(self._top_up())
+
+    async def acquire_page(self):
+        """Hand out a pre-warmed page (refilling the pool in the background), or open one inline."""
+        try:
+            while self._idle_pages:
+                page, _ = self._idle_pages.pop()
+                if not page.is_closed():
+                    return page
+            context = await self.new_context()
+            return await context.new_page()
+        finally:
+            self._schedule_top_up()
+
+    async def close_page(self, page):
+        """Close the page together with its context, freeing everything Playwright tracked for it."""
+        self._reuses.pop(page, None)
+        self._lean_pages.discard(page)
+        try:
+            await page.context.close()
+        except Exception:
+            pass
+
+    async def release_page(self, page):
+        """
+        Return a page that never held a user session to the pool, parked on the login form like the
+        pages _top_up creates. It is closed instead if the pool is full or the page has been recycled
+        POOLED_PAGE_MAX_REUSES times (its context keeps growing).
+        """
+        uses = self._reuses.get(page, 0) + 1
+        try:
+            if not page.is_closed() and len(self._idle_pages) < MAX_POOLED_PAGES and uses < POOLED_PAGE_MAX_REUSES:
+                await page.context.clear_cookies()
+                try:
+                    async with self.lean_loading(page):
+                        await page.goto(ERP_LOGIN_URL, wait_until="domcontentloaded")
+                except Exception:
+                    await page.goto("about:blank")  # don't leave the last form's values around; erp_login navigates it
+                self._reuses[page] = uses
+                self._idle_pages.append((page, time.monotonic()))
+                return
+        except Exception:
+            pass
+        await self.close_page(page)
+
+    async def evict_stale_pages(self):
+        """Close pooled pages nobody has taken for a while; the pool refills on the next acquire."""
+        cutoff = time.monotonic() - POOLED_PAGE_IDLE_SECONDS
+        stale = [page for page, parked_at in self._idle_pages if parked_at < cutoff]
+        if not stale:
+            return
+        self._idle_pages = [(page, parked_at) for page, parked_at in self._idle_pages if parked_at >= cutoff]
+        for page in stale:
+            await self.close_page(page)
+        logger.debug("Closed %d idle pooled page(s)", len(stale))
+
+    @asynccontextmanager
+    async def lean_loading(self, page):
+        """Abort image/font/media requests and serve ERP static assets from memory while the block is active."""
+        # Handlers for one chat can overlap on its page; the route stays until the last of them exits.
+        first = not self._lean_users.get(page)
+        self._lean_users[page] = self._lean_users.get(page, 0) + 1
+        try:
+            if first:
+                await page.route("**/*", _block_heavy_resources)
+            yield page
+        finally:
+            self._lean_pages.add(page)
+            self._lean_users[page] -= 1
+            if not self._lean_users[page]:
+                del self._lean_users[page]
+                await page.unroute("**/*", _block_heavy_resources)
+
+    async def show(self, page, url: str):
+        """Put ``url`` on the page with every resource loaded, reusing it only if it was loaded in full."""
+        if page in self._lean_pages or not _is_on(page, url):
+            await page.goto(url, wait_until="load")
+            self._lean_pages.discard(page)
+
+    async def screenshot(self, page, prefix="shot", full_page=True, reload_lean=True) -> BufferedInputFile:
+        """
+        Capture the page in memory, ready to upload without touching disk. A page last loaded under
+        lean_loading is missing its images, so it is loaded again in full first unless ``reload_lean``
+        is off (reloading would lose state worth capturing, such as a login error).
+        """
+        if reload_lean and page in self._lean_pages:
+            await self.show(page, page.url)
+        await page.wait_for_load_state("load")  # extractors only wait for the DOM; let images land
+        data = await page.screenshot(full_page=full_page, type="jpeg", quality=SCREENSHOT_JPEG_QUALITY)
+        return BufferedInputFile(data, filename=f"{prefix}.jpg")
 
 
 browser_manager = BrowserManager()
@@ -203,16 +515,15 @@ PAGES = {
     "🎓 Convocation":  "https://noble.icrp.in/academic/Student-cp/Form_student_Convocation_Registration.aspx",
 }
 
-PAGE_KEYS = list(PAGES.keys())
-PAGE_VALS = list(PAGES.values())
+PAGE_ITEMS = tuple(PAGES.items())  # (name, url) by the index used in "page_<i>" callbacks
 
 
-def get_menu():
+def _build_main_menu():
     rows = []
-    for i in range(0, len(PAGE_KEYS), 4):
+    for i in range(0, len(PAGE_ITEMS), 4):
         row = [
-            InlineKeyboardButton(text=PAGE_KEYS[j], callback_data=f"page_{j}")
-            for j in range(i, min(i + 4, len(PAGE_KEYS)))
+            InlineKeyboardButton(text=PAGE_ITEMS[j][0], callback_data=f"page_{j}")
+            for j in range(i, min(i + 4, len(PAGE_ITEMS)))
         ]
         rows.append(row)
     rows.append([
@@ -227,47 +538,186 @@ def get_menu():
     ])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-def get_attendance_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="📅 View Daily Log", callback_data="att_daily")],
-        [InlineKeyboardButton(text="🔙 Back to Menu",   callback_data="show_menu")],
-    ])
+# Pure data: built once at import and shared by every reply that shows the main menu.
+MAIN_MENU = _build_main_menu()
 
-def get_fees_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🧾 All Transactions", callback_data="fees_detail")],
-        [InlineKeyboardButton(text="🔙 Back to Menu",      callback_data="show_menu")],
-    ])
 
-def get_back_menu():
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="🔙 Back to Menu", callback_data="show_menu")]
-    ])
+ATTENDANCE_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="📅 View Daily Log", callback_data="att_daily")],
+    [InlineKeyboardButton(text="🔙 Back to Menu",   callback_data="show_menu")],
+])
+
+FEES_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🧾 All Transactions", callback_data="fees_detail")],
+    [InlineKeyboardButton(text="🔙 Back to Menu",      callback_data="show_menu")],
+])
+
+BACK_MENU = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="🔙 Back to Menu", callback_data="show_menu")]
+])
 
 # ================= SESSION HELPERS =================
 
+ERP_LOGIN_URL = "https://noble.icrp.in/academic/"
+LOGIN_USERNAME_SELECTOR = 'input[name="txt_uname"]'
+LOGIN_PASSWORD_SELECTOR = 'input[name="txt_password"]'
+LOGIN_SUBMIT_SELECTOR = 'input[type="submit"]'
+HIDE_POPUP_SELECTOR = "span[onclick='hide_popup();']"
+LOGOUT_LINK_SELECTOR = "a:has-text('Logout')"
+
+# Installed on every context: closes the announcement popup whenever a page shows it, so no
+# Python code has to wait for it. Watches only the first few seconds after the DOM is ready.
+_JS_AUTO_DISMISS_POPUP = """
+(() => {
+    const dismiss = () => document.querySelectorAll(%s).forEach((el) => {
+        if (el.offsetParent !== null) el.click();
+    });
+    document.addEventListener('DOMContentLoaded', () => {
+        dismiss();
+        const observer = new MutationObserver(dismiss);
+        observer.observe(document.body, {
+            childList: true, subtree: true, attributes: true, attributeFilter: ['style', 'class'],
+        });
+        setTimeout(() => observer.disconnect(), 5000);
+    });
+})();
+""" % json.dumps(HIDE_POPUP_SELECTOR)
+
+# Any one of these means a logged-in ERP page has rendered.
+DASHBOARD_SELECTOR = ", ".join([
+    LOGOUT_LINK_SELECTOR,
+    "table[id$='grd_syllabus']",
+    "table[id$='grd_notif']",
+    "h3.content-header-title:has-text('Dashboard')",
+    "span#ctl00_lbl_name",
+])
+
+LOGIN_ERROR_SELECTOR = "span#lbl_msg"
+
+# Success and failure markers in one selector, so whichever renders first ends the wait. The
+# username field is left out: it is still on screen before the post-back lands, and a login that
+# shows neither marker simply times out into the URL check.
+LOGIN_OUTCOME_SELECTOR = ", ".join([DASHBOARD_SELECTOR, LOGIN_ERROR_SELECTOR])
+
+def on_login_form(page) -> bool:
+    """True if the page already shows the ERP login form (a warm pooled page, or a redirect after expiry)."""
+    url = page.url.lower()
+    return url.startswith(ERP_LOGIN_URL) and "/student-cp/" not in url
+
 def is_expired(session):
     return datetime.now() > session["expires"]
 
 def refresh_session(chat_id):
     if chat_id in user_sessions:
         user_sessions[chat_id]["expires"] = datetime.now() + timedelta(minutes=SESSION_TIMEOUT_MINUTES)
+        user_sessions.move_to_end(chat_id)
+
+async def remember_login_state(page, username: str):
+    """Cache the cookies of a fresh ERP login so the next auto-login can replay them."""
+    login_state_cache[username] = await page.context.cookies(ERP_LOGIN_URL)
 
-async def close_session(chat_id):
+async def restore_login_state(page, username: str) -> bool:
+    """Replay cached ERP cookies on the page. True if they still reach the dashboard."""
+    cookies = login_state_cache.get(username)
+    if not cookies:
+        return False
+    await page.context.add_cookies(cookies)
+    await page.goto(PAGES["🏠 Dashboard"], wait_until="domcontentloaded")
+    if "Home_student" in page.url:
+        return True
+    login_state_cache.pop(username, None)
+    await page.context.clear_cookies()
+    return False
+
+async def open_session(chat_id, page) -> dict:
+    """Bind a logged-in page to the chat, releasing any page it held before."""
+    old = user_sessions.get(chat_id)
+    if old and old["page"] is not page:
+        await browser_manager.close_page(old["page"])
+    session = {
+        "context": page.context,
+        "page": page,
+        "expires": datetime.now() + timedelta(minutes=SESSION_TIMEOUT_MINUTES),
+        "cache": {},
+        "verified_at": time.monotonic(),  # open_session is only called right after a successful login
+    }
+    user_sessions[chat_id] = session
+    user_sessions.move_to_end(chat_id)
+    # Over the cap: drop the least recently used sessions; they auto-login again on next use.
+    while len(user_sessions) > MAX_ACTIVE_SESSIONS:
+        evicted = next(iter(user_sessions))
+        logger.info("Session cap %d reached; evicting least recently used chat %s", MAX_ACTIVE_SESSIONS, evicted)
+        await close_session(evicted)
+    return session
+
+async def close_session(chat_id, forget_login: bool = False):
+    """Close the chat's session; with ``forget_login`` its cached ERP cookies are dropped as well."""
     session = user_sessions.pop(chat_id, None)
+    if forget_login:
+        creds = get_credentials(chat_id)
+        if creds:
+            login_state_cache.pop(creds[0], None)
     if session:
-        try:
-            await session["page"].close()
-            await session["context"].close()
-        except Exception:
-            pass
-        logger.info(f"Session closed for {chat_id}")
+        await browser_manager.close_page(session["page"])
+        logger.info("Session closed for %s", chat_id)
 
-async def verify_logged_in(page) -> bool:
+# Pages swapped out by recycle_if_worn; an action that started before the swap may still be using
+# one, so the reaper closes them on its next pass instead.
+retired_pages: List = []
+
+async def recycle_if_worn(session):
+    """
+    Count one more action on the session; every SESSION_RECYCLE_AFTER actions, move it to a fresh
+    context carrying the same ERP cookies. Playwright only frees what it tracked for a context when
+    that context closes, so a long-lived session would otherwise keep growing.
+    """
+    session["uses"] = session.get("uses", 0) + 1
+    if session["uses"] < SESSION_RECYCLE_AFTER:
+        return
+    session["uses"] = 0
+    old = session["page"]
+    page = None
     try:
-        return await page.query_selector("a:has-text('Logout')") is not None
+        page = await browser_manager.acquire_page()
+        await page.context.add_cookies(await old.context.cookies(ERP_LOGIN_URL))
+        async with browser_manager.lean_loading(page):
+            await page.goto(PAGES["🏠 Dashboard"], wait_until="domcontentloaded")
+    except Exception as e:
+        logger.warning("Session recycle failed: %s", e)
+    if page is None:
+        return  # keep using the old context
+    if "Home_student" not in page.url:
+        await browser_manager.close_page(page)
+        return
+    session["page"] = page
+    session["context"] = page.context
+    session["verified_at"] = time.monotonic()
+    retired_pages.append(old)
+
+async def reap_idle_sessions():
+    """Close sessions (and pooled pages) that have sat idle so their browser contexts are freed."""
+    while True:
+        await asyncio.sleep(SESSION_REAP_INTERVAL)
+        expired = [chat_id for chat_id, session in user_sessions.items() if is_expired(session)]
+        if expired:
+            logger.info("Reaping %d idle session(s); %d remain", len(expired), len(user_sessions) - len(expired))
+        for chat_id in expired:
+            await close_session(chat_id)
+        while retired_pages:
+            await browser_manager.close_page(retired_pages.pop())
+        await browser_manager.evict_stale_pages()
+
+async def verify_logged_in(session) -> bool:
+    """True if the session's page is still logged in; trusts a recent confirmation without asking the browser."""
+    if time.monotonic() - session["verified_at"] < SESSION_VERIFY_INTERVAL:
+        return True
+    try:
+        alive = await session["page"].locator(DASHBOARD_SELECTOR).count() > 0
     except Exception:
         return False
+    if alive:
+        session["verified_at"] = time.monotonic()
+    return alive
 
 # ================= ERP DATA EXTRACTORS =================
 
@@ -284,29 +734,91 @@ def _is_junk(text: str) -> bool:
         or text in ("-", "—", "/", "P", "H", "A", "S")
     )
 
+# Resolves as soon as a DOM mutation leaves no template placeholders behind,
+# instead of re-checking on every animation frame.
+_JS_WAIT_FOR_ANGULAR = """
+(timeout) => new Promise((resolve) => {
+    const rendered = () => {
+        const text = document.body.innerText;
+        return !text.includes('{{') && !text.includes('}}');
+    };
+    if (rendered()) return resolve(true);
+    const observer = new MutationObserver(() => {
+        if (rendered()) { observer.disconnect(); clearTimeout(timer); resolve(true); }
+    });
+    const timer = setTimeout(() => { observer.disconnect(); resolve(false); }, timeout);
+    observer.observe(document.body, { childList: true, subtree: true, characterData: true });
+})
+"""
+
 async def _wait_for_angular(page, timeout: int = 10000):
     """Wait until Angular template placeholders are gone from the DOM."""
     try:
-        await page.wait_for_function(
-            "() => !document.body.innerText.includes('{{') && !document.body.innerText.includes('}}')",
-            timeout=timeout,
-        )
+        await page.evaluate(_JS_WAIT_FOR_ANGULAR, timeout)
     except Exception:
         pass  # proceed anyway; we'll filter junk rows ourselves
 
+def _bounded(extractor):
+    """Run an extractor under the shared scrape semaphore so bursts queue instead of thrashing Chromium."""
+    @functools.wraps(extractor)
+    async def wrapper(page, *args, **kwargs):
+        async with browser_manager.scrape_semaphore:
+            return await extractor(page, *args, **kwargs)
+    return wrapper
+
+async def _erp_cookie_jar(page) -> dict:
+    """Name -> value for the cookies the ERP host would receive, leaving out third-party ones."""
+    cookies_list = await page.context.cookies(ERP_LOGIN_URL)
+    return {c["name"]: c["value"] for c in cookies_list}
+
+async def _call_page_method(sess, url: str, payload: dict, referer: str) -> list:
+    """POST to an ASP.NET page method and unwrap its {"d": ...} envelope into a list."""
+    async with sess.post(
+        url,
+        json=payload,
+        headers={"Content-Type": "application/json", "Referer": referer},
+        timeout=aiohttp.ClientTimeout(total=15),
+    ) as resp:
+        raw = await resp.json(content_type=None)
+    d = raw.get("d", [])
+    if isinstance(d, str):
+        d = json.loads(d)
+    return d if isinstance(d, list) else []
+
+def _is_on(page, url: str) -> bool:
+    """True if the page is already showing ``url`` (ignoring any query string)."""
+    return page.url.split("?", 1)[0].lower() == url.lower()
+
+async def _goto(page, url: str, ready_selector: Optional[str] = None, timeout: int = 10000, reuse: bool = False):
+    """
+    Navigate once the DOM is parsed, then wait for the element that carries the data.
+    With ``reuse`` the navigation is skipped when the page is already on ``url``.
+    """
+    if reuse and _is_on(page, url):
+        return
+    await page.goto(url, wait_until="domcontentloaded")
+    if ready_selector:
+        try:
+            await page.locator(ready_selector).first.wait_for(state="attached", timeout=timeout)
+        except PlaywrightTimeoutError:
+            pass  # let the extractor report whatever is there
+
 
 # ─────────────────────────────────────────────────────────────
 #  PROFILE  ─  Extract from ASP.NET label elements directly
 # ─────────────────────────────────────────────────────────────
+@_bounded
 async def extract_profile(page) -> dict:
     """
     Extract full student profile from the ASP.NET profile page.
     Uses specific label IDs known from the page source.
     """
     try:
-        await page.goto(PAGE_VALS[PAGE_KEYS.index("👤 Profile")], wait_until="networkidle")
-        await asyncio.sleep(1)
-        await _wait_for_angular(page)
+        # The lbl_* spans are rendered server-side, so once the name label exists
+        # every field is in the DOM and a single evaluate reads them all. Profile
+        # details don't change within a session, so an already-open profile is reused;
+        # BrowserManager.screenshot reloads it in full if it was opened lean.
+        await _goto(page, PAGES["👤 Profile"], "#ctl00_ContentPlaceHolder1_lbl_name", reuse=True)
 
         profile = await page.evaluate("""
         () => {
@@ -354,100 +866,70 @@ async def extract_profile(page) -> dict:
         profile["extracted_at"] = datetime.now().isoformat()
         return {"profile": profile, "extracted_at": profile["extracted_at"]}
     except Exception as e:
-        logger.error(f"extract_profile error: {e}")
+        logger.error("extract_profile error: %s", e)
         return {"error": str(e)}
 
 
 # ─────────────────────────────────────────────────────────────
 #  RESULT  ─  Call Angular API endpoint like the page does
 # ─────────────────────────────────────────────────────────────
+RESULT_URL = "https://noble.icrp.in/academic/Student-cp/Student_Result.aspx"
+
+@_bounded
 async def extract_result(page) -> dict:
     """
     Extract exam results by calling the Angular/ASP.NET API endpoint
     that the Student_Result.aspx page uses internally.
     """
     try:
-        # Navigate to result page first to establish session cookies
-        await page.goto(
-            "https://noble.icrp.in/academic/Student-cp/Student_Result.aspx",
-            wait_until="networkidle"
-        )
-        await asyncio.sleep(1)
+        # Navigate to result page first to establish session cookies;
+        # they arrive with the response headers, so no settle delay is needed.
+        await _goto(page, RESULT_URL, reuse=True)
 
         # Grab cookies for authenticated API call
-        import aiohttp as _aiohttp
-        cookies_list = await page.context.cookies()
-        cookie_jar = {c["name"]: c["value"] for c in cookies_list}
+        cookie_jar = await _erp_cookie_jar(page)
+
+        # 1. List of exam results  +  2. consolidated performance / SGPA / backlogs
+        async with http_session(cookies=cookie_jar) as sess:
+            result_rows, backlog_rows = await asyncio.gather(
+                _call_page_method(sess, f"{RESULT_URL}/ListStudentResult", {"filter_mode": 0}, RESULT_URL),
+                _call_page_method(sess, f"{RESULT_URL}/Get_student_total_backlog_and_attempt", {}, RESULT_URL),
+            )
 
         results = []
-        backlog_data = []
+        for item in result_rows:
+            results.append({
+                "enrollment":        item.get("Student_Code", ""),
+                "name":              item.get("Student_Name", ""),
+                "program":           item.get("Degree_Name", ""),
+                "semester":          item.get("Semester_Name", ""),
+                "exam":              item.get("exam_name", ""),
+                "exam_type":         item.get("student_exam_type", ""),
+                "result_declared":   item.get("is_result_declare", 0),
+                "swd_sem_id":        item.get("swd_sem_id"),
+                "swd_term_id":       item.get("swd_term_id"),
+                "swd_year_id":       item.get("swd_year_id"),
+                "swd_id":            item.get("swd_id"),
+                "swd_college_id":    item.get("swd_college_id"),
+                "degree_id":         item.get("Degree_id"),
+                "student_id":        item.get("Student_Id"),
+            })
 
-        # 1. Get list of exam results
-        api_url = "https://noble.icrp.in/academic/Student-cp/Student_Result.aspx/ListStudentResult"
-        async with _aiohttp.ClientSession(cookies=cookie_jar) as sess:
-            async with sess.post(
-                api_url,
-                json={"filter_mode": 0},
-                headers={
-                    "Content-Type": "application/json",
-                    "Referer": "https://noble.icrp.in/academic/Student-cp/Student_Result.aspx",
-                },
-                timeout=_aiohttp.ClientTimeout(total=15),
-            ) as resp:
-                raw = await resp.json(content_type=None)
-                d = raw.get("d", [])
-                if isinstance(d, str):
-                    d = json.loads(d)
-                if isinstance(d, list):
-                    for item in d:
-                        results.append({
-                            "enrollment":        item.get("Student_Code", ""),
-                            "name":              item.get("Student_Name", ""),
-                            "program":           item.get("Degree_Name", ""),
-                            "semester":          item.get("Semester_Name", ""),
-                            "exam":              item.get("exam_name", ""),
-                            "exam_type":         item.get("student_exam_type", ""),
-                            "result_declared":   item.get("is_result_declare", 0),
-                            "swd_sem_id":        item.get("swd_sem_id"),
-                            "swd_term_id":       item.get("swd_term_id"),
-                            "swd_year_id":       item.get("swd_year_id"),
-                            "swd_id":            item.get("swd_id"),
-                            "swd_college_id":    item.get("swd_college_id"),
-                            "degree_id":         item.get("Degree_id"),
-                            "student_id":        item.get("Student_Id"),
-                        })
-
-        # 2. Get consolidated performance / SGPA / backlogs
-        backlog_url = "https://noble.icrp.in/academic/Student-cp/Student_Result.aspx/Get_student_total_backlog_and_attempt"
-        async with _aiohttp.ClientSession(cookies=cookie_jar) as sess:
-            async with sess.post(
-                backlog_url,
-                json={},
-                headers={
-                    "Content-Type": "application/json",
-                    "Referer": "https://noble.icrp.in/academic/Student-cp/Student_Result.aspx",
-                },
-                timeout=_aiohttp.ClientTimeout(total=15),
-            ) as resp:
-                raw = await resp.json(content_type=None)
-                d = raw.get("d", [])
-                if isinstance(d, str):
-                    d = json.loads(d)
-                if isinstance(d, list):
-                    for item in d:
-                        try:
-                            sgpa = float(str(item.get("ssrd_SGPA", 0)).replace(",", "").strip())
-                        except Exception:
-                            sgpa = 0.0
-                        backlog_data.append({
-                            "semester":      item.get("semester_name", ""),
-                            "sgpa":          sgpa,
-                            "backlogs":      item.get("Total_backlog", 0),
-                            "attempts":      item.get("Total_Attempt", 0),
-                            "enrollment_no": item.get("enrollment_no", ""),
-                            "student_name":  item.get("student_name", ""),
-                            "degree_name":   item.get("Degree_Name", ""),
-                        })
+        backlog_data = []
+        for item in backlog_rows:
+            try:
+                sgpa = float(str(item.get("ssrd_SGPA", 0)).replace(",", "").strip())
+            except Exception:
+                sgpa = 0.0
+            backlog_data.append({
+                "semester":      item.get("semester_name", ""),
+                "sgpa":          sgpa,
+                "backlogs":      item.get("Total_backlog", 0),
+                "attempts":      item.get("Total_Attempt", 0),
+                "enrollment_no": item.get("enrollment_no", ""),
+                "student_name":  item.get("student_name", ""),
+                "degree_name":   item.get("Degree_Name", ""),
+            })
 
         return {
             "results":  results,
@@ -456,7 +938,7 @@ async def extract_result(page) -> dict:
         }
 
     except Exception as e:
-        logger.error(f"extract_result error: {e}")
+        logger.error("extract_result error: %s", e)
         return {"error": str(e)}
 
 
@@ -466,10 +948,10 @@ async def extract_result(page) -> dict:
 #            read each row by fixed column index (0=Sr, 1=Type,
 #            2=Amount, 3=Payment Mode) and skip duplicate rows.
 # ─────────────────────────────────────────────────────────────
+@_bounded
 async def extract_fees(page) -> dict:
     try:
-        await page.goto(PAGE_VALS[PAGE_KEYS.index("\U0001f4b0 Fees")], wait_until="networkidle")
-        await asyncio.sleep(1)
+        await _goto(page, PAGES["\U0001f4b0 Fees"], '[id*="grd_inst_fee"]')
 
         fees = await page.evaluate("""
         () => {
@@ -524,105 +1006,97 @@ async def extract_fees(page) -> dict:
         return fees
 
     except Exception as e:
-        logger.error(f"extract_fees error: {e}")
+        logger.error("extract_fees error: %s", e)
         return {"error": str(e)}
 
 
+ATTENDANCE_API_URL = (
+    "https://noble.icrp.in/academic/Student-cp/Form_Students_Lecture_Wise_Attendance.aspx/ListAttendanceStudent"
+)
+
+# Student labels and the lecture-wise grid, read in a single evaluate.
+_JS_EXTRACT_ATTENDANCE = (
+    "() => {"
+    "  const lectures = [];"
+    "  const lecDiv = document.querySelector(\"[id*='div_lec_att']\");"
+    "  if (!lecDiv) return { lectures: [], student: {}, headers: [] };"
+    "  const table = lecDiv.querySelector(\"table\");"
+    "  if (!table) return { lectures: [], student: {}, headers: [] };"
+    "  const headerThs = Array.from(table.querySelectorAll(\"th\"));"
+    "  const headers = headerThs.map(th => th.innerText.trim().replace(/ +/g, \" \").replace(/\\n/g, \" \"));"
+    "  const rows = Array.from(table.querySelectorAll(\"tr\")).slice(1);"
+    "  for (const row of rows) {"
+    "    const cells = Array.from(row.querySelectorAll(\"td\"));"
+    "    if (cells.length < 2) continue;"
+    "    const slotNum = cells[0].innerText.trim();"
+    "    if (!slotNum || isNaN(parseInt(slotNum))) continue;"
+    "    const days = [];"
+    "    for (let i = 1; i < cells.length; i++) {"
+    "      const cell = cells[i];"
+    "      const header = headers[i] || \"\";"
+    "      const statusDiv = cell.querySelector(\"div\");"
+    "      let status = statusDiv ? statusDiv.innerText.trim() : cell.innerText.trim();"
+    "      if (!status) status = \"-\";"
+    "      const tooltip = cell.querySelector(\".tooltiptext\");"
+    "      let faculty = \"\", topic = \"\", reason = \"\";"
+    "      if (tooltip) {"
+    "        const h = tooltip.innerHTML;"
+    "        const fm = h.match(/Faculty:[^>]*>([^<]+)/);"
+    "        const tm = h.match(/Topic:[^>]*>([^<]+)/);"
+    "        const rm = h.match(/Reason:[^>]*>([^<]*)/);"
+    "        faculty = fm ? fm[1].trim() : \"\";"
+    "        topic   = tm ? tm[1].trim() : \"\";"
+    "        reason  = rm ? rm[1].trim() : \"\";"
+    "      }"
+    "      days.push({ date: header, status: status, faculty: faculty, topic: topic, reason: reason });"
+    "    }"
+    "    lectures.push({ slot: parseInt(slotNum), days: days });"
+    "  }"
+    "  const g = function(id) { const e = document.getElementById(id); return e ? e.innerText.trim() : \"\"; };"
+    "  const student = {"
+    "    name:       g(\"ctl00_ContentPlaceHolder1_lbl_name\"),"
+    "    enrollment: g(\"ctl00_ContentPlaceHolder1_lbl_enroll\"),"
+    "    college:    g(\"ctl00_ContentPlaceHolder1_lbl_coll\"),"
+    "    department: g(\"ctl00_ContentPlaceHolder1_lbl_dept\"),"
+    "    course:     g(\"ctl00_ContentPlaceHolder1_lbl_course\"),"
+    "    semester:   g(\"ctl00_ContentPlaceHolder1_lbl_sm\"),"
+    "    division:   g(\"ctl00_ContentPlaceHolder1_lbl_div\"),"
+    "    batch:      g(\"ctl00_ContentPlaceHolder1_lbl_batch\"),"
+    "    term:       g(\"ctl00_ContentPlaceHolder1_lbl_term\")"
+    "  };"
+    "  return { lectures: lectures, student: student, headers: headers };"
+    "}"
+)
+
+@_bounded
 async def extract_attendance(page) -> dict:
     try:
-        await page.goto(PAGE_VALS[PAGE_KEYS.index("📋 Attendance")], wait_until="networkidle")
-        await asyncio.sleep(1)
+        await _goto(page, PAGES["📋 Attendance"], "[id*='div_lec_att'] table")
 
-        monthly = []
-        try:
-            import aiohttp as _aiohttp
-            cookies_list = await page.context.cookies()
-            cookie_jar = {c["name"]: c["value"] for c in cookies_list}
-
-            api_url = "https://noble.icrp.in/academic/Student-cp/Form_Students_Lecture_Wise_Attendance.aspx/ListAttendanceStudent"
-            async with _aiohttp.ClientSession(cookies=cookie_jar) as sess:
-                async with sess.post(
-                    api_url,
-                    json={},
-                    headers={
-                        "Content-Type": "application/json",
-                        "Referer": PAGE_VALS[PAGE_KEYS.index("📋 Attendance")],
-                    },
-                    timeout=_aiohttp.ClientTimeout(total=15),
-                ) as resp:
-                    raw = await resp.json(content_type=None)
-                    d = raw.get("d", [])
-                    if isinstance(d, str):
-                        d = json.loads(d)
-                    if isinstance(d, list):
-                        for i, c in enumerate(d):
-                            monthly.append({
-                                "sr":             i + 1,
-                                "month":          c.get("month", ""),
-                                "total_arranged": c.get("total_arrange_lect", 0),
-                                "remaining":      c.get("remaning", 0),
-                                "total_lectures": c.get("total_lecture_for_stud", 0),
-                                "absent":         c.get("absent_lecture", 0),
-                                "present":        c.get("present_lecture", 0),
-                                "percentage":     c.get("persentage", 0),
-                            })
-        except Exception as e:
-            logger.warning(f"Monthly API call failed: {e}")
+        async def fetch_monthly() -> list:
             monthly = []
+            try:
+                cookie_jar = await _erp_cookie_jar(page)
+                async with http_session(cookies=cookie_jar) as sess:
+                    rows = await _call_page_method(sess, ATTENDANCE_API_URL, {}, PAGES["📋 Attendance"])
+                for i, c in enumerate(rows):
+                    monthly.append({
+                        "sr":             i + 1,
+                        "month":          c.get("month", ""),
+                        "total_arranged": c.get("total_arrange_lect", 0),
+                        "remaining":      c.get("remaning", 0),
+                        "total_lectures": c.get("total_lecture_for_stud", 0),
+                        "absent":         c.get("absent_lecture", 0),
+                        "present":        c.get("present_lecture", 0),
+                        "percentage":     c.get("persentage", 0),
+                    })
+            except Exception as e:
+                logger.warning("Monthly API call failed: %s", e)
+                monthly = []
+            return monthly
 
-        _js_att = (
-            "() => {"
-            "  const lectures = [];"
-            "  const lecDiv = document.querySelector(\"[id*='div_lec_att']\");"
-            "  if (!lecDiv) return { lectures: [], student: {}, headers: [] };"
-            "  const table = lecDiv.querySelector(\"table\");"
-            "  if (!table) return { lectures: [], student: {}, headers: [] };"
-            "  const headerThs = Array.from(table.querySelectorAll(\"th\"));"
-            "  const headers = headerThs.map(th => th.innerText.trim().replace(/ +/g, \" \").replace(/\\n/g, \" \"));"
-            "  const rows = Array.from(table.querySelectorAll(\"tr\")).slice(1);"
-            "  for (const row of rows) {"
-            "    const cells = Array.from(row.querySelectorAll(\"td\"));"
-            "    if (cells.length < 2) continue;"
-            "    const slotNum = cells[0].innerText.trim();"
-            "    if (!slotNum || isNaN(parseInt(slotNum))) continue;"
-            "    const days = [];"
-            "    for (let i = 1; i < cells.length; i++) {"
-            "      const cell = cells[i];"
-            "      const header = headers[i] || \"\";"
-            "      const statusDiv = cell.querySelector(\"div\");"
-            "      let status = statusDiv ? statusDiv.innerText.trim() : cell.innerText.trim();"
-            "      if (!status) status = \"-\";"
-            "      const tooltip = cell.querySelector(\".tooltiptext\");"
-            "      let faculty = \"\", topic = \"\", reason = \"\";"
-            "      if (tooltip) {"
-            "        const h = tooltip.innerHTML;"
-            "        const fm = h.match(/Faculty:[^>]*>([^<]+)/);"
-            "        const tm = h.match(/Topic:[^>]*>([^<]+)/);"
-            "        const rm = h.match(/Reason:[^>]*>([^<]*)/);"
-            "        faculty = fm ? fm[1].trim() : \"\";"
-            "        topic   = tm ? tm[1].trim() : \"\";"
-            "        reason  = rm ? rm[1].trim() : \"\";"
-            "      }"
-            "      days.push({ date: header, status: status, faculty: faculty, topic: topic, reason: reason });"
-            "    }"
-            "    lectures.push({ slot: parseInt(slotNum), days: days });"
-            "  }"
-            "  const g = function(id) { const e = document.getElementById(id); return e ? e.innerText.trim() : \"\"; };"
-            "  const student = {"
-            "    name:       g(\"ctl00_ContentPlaceHolder1_lbl_name\"),"
-            "    enrollment: g(\"ctl00_ContentPlaceHolder1_lbl_enroll\"),"
-            "    college:    g(\"ctl00_ContentPlaceHolder1_lbl_coll\"),"
-            "    department: g(\"ctl00_ContentPlaceHolder1_lbl_dept\"),"
-            "    course:     g(\"ctl00_ContentPlaceHolder1_lbl_course\"),"
-            "    semester:   g(\"ctl00_ContentPlaceHolder1_lbl_sm\"),"
-            "    division:   g(\"ctl00_ContentPlaceHolder1_lbl_div\"),"
-            "    batch:      g(\"ctl00_ContentPlaceHolder1_lbl_batch\"),"
-            "    term:       g(\"ctl00_ContentPlaceHolder1_lbl_term\")"
-            "  };"
-            "  return { lectures: lectures, student: student, headers: headers };"
-            "}"
-        )
-        dom_data = await page.evaluate(_js_att)
+        # The monthly API call and the lecture-table read are independent; overlap them.
+        monthly, dom_data = await asyncio.gather(fetch_monthly(), page.evaluate(_JS_EXTRACT_ATTENDANCE))
 
         return {
             "monthly":   monthly,
@@ -633,13 +1107,14 @@ async def extract_attendance(page) -> dict:
         }
 
     except Exception as e:
-        logger.error(f"extract_attendance error: {e}")
+        logger.error("extract_attendance error: %s", e)
         return {"error": str(e)}
 
 
+@_bounded
 async def extract_exam(page) -> dict:
     try:
-        await page.goto(PAGE_VALS[PAGE_KEYS.index("📝 Exam")], wait_until="networkidle")
+        await _goto(page, PAGES["📝 Exam"])
         await _wait_for_angular(page)
 
         results = await page.evaluate("""
@@ -734,7 +1209,7 @@ def format_profile_message(data: dict) -> str:
     row("Admission Year",   p.get("admission_year", ""))
     row("Admission Type",   p.get("admission_type", ""))
 
-    lines += ["", f"🕐 _Updated: {datetime.now().strftime('%d %b %Y, %H:%M')}_"]
+    lines += ["", f"🕐 _Updated: {time.strftime('%d %b %Y, %H:%M')}_"]
     return "\n".join(lines)
 
 
@@ -799,7 +1274,7 @@ def format_result_message(data: dict) -> str:
             f"📌 *Total Backlogs: {total_backlogs}*",
         ]
 
-    lines.append(f"\n🕐 _Updated: {datetime.now().strftime('%d %b %Y, %H:%M')}_")
+    lines.append(f"\n🕐 _Updated: {time.strftime('%d %b %Y, %H:%M')}_")
     return "\n".join(lines)
 
 
@@ -827,7 +1302,7 @@ def format_fees_message(data: dict) -> str:
     total_paid = data.get("total_paid", 0)
     lines = [
         "\U0001f4b0 *Fee Payment Summary*",
-        f"\U0001f4c5 As of: {datetime.now().strftime('%d %b %Y')}",
+        f"\U0001f4c5 As of: {time.strftime('%d %b %Y')}",
         "\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501",
     ]
     for head, info in grouped.items():
@@ -866,6 +1341,17 @@ def format_fees_detail_message(data: dict) -> str:
     return "\n".join(lines)
 
 
+DIVIDER = "\u2501" * 22
+
+# Per-month block and its ten-step progress bars, built once instead of per row.
+ATT_MONTH_FMT = (
+    "\n{emoji} *{month}*\n"
+    "   `{bar}` {pct:.1f}%\n"
+    "   \u2705 Present: {present}  \u274c Absent: {absent}  \U0001f4da Total: {total}\n"
+    "   \U0001f4dd Arranged: {arranged}  — {status}"
+)
+ATT_BARS = ["\u2588" * i + "\u2591" * (10 - i) for i in range(11)]
+
 def format_attendance_message(data: dict) -> str:
     if "error" in data:
         return f"\u274c Could not extract attendance: {data['error']}"
@@ -890,7 +1376,7 @@ def format_attendance_message(data: dict) -> str:
         lines.append(f"\U0001f393 {name} | {course} {sem}")
     if term:
         lines.append(f"\U0001f4c5 Term: {term}")
-    lines.append("\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501")
+    lines.append(DIVIDER)
 
     all_pcts = []
     for m in monthly:
@@ -911,17 +1397,14 @@ def format_attendance_message(data: dict) -> str:
         elif pct >= 60: emoji, status = "\U0001f7e0", "\u26a0\ufe0f Low"
         else:           emoji, status = "\U0001f534", "\u274c Critical"
 
-        filled = int(pct / 10)
-        bar = "\u2588" * filled + "\u2591" * (10 - filled)
+        bar = ATT_BARS[max(0, min(int(pct / 10), 10))]
 
-        lines.append(
-            f"\n{emoji} *{month_name}*\n"
-            f"   `{bar}` {pct:.1f}%\n"
-            f"   \u2705 Present: {present}  \u274c Absent: {absent}  \U0001f4da Total: {total}\n"
-            f"   \U0001f4dd Arranged: {arranged}  — {status}"
-        )
+        lines.append(ATT_MONTH_FMT.format(
+            emoji=emoji, month=month_name, bar=bar, pct=pct, present=present,
+            absent=absent, total=total, arranged=arranged, status=status,
+        ))
 
-    lines.append("\n\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501")
+    lines.append("\n" + DIVIDER)
     if all_pcts:
         avg = sum(all_pcts) / len(all_pcts)
         low = sum(1 for p in all_pcts if p < 75)
@@ -934,6 +1417,11 @@ def format_attendance_message(data: dict) -> str:
     return "\n".join(lines)
 
 
+DAILY_STATUS_ICONS = {
+    "P": "\u2705", "A": "\u274c", "H": "\U0001f3d6",
+    "S": "\u26d4", "L": "\U0001f4dd", "R": "\u23f3", "-": "\u2796"
+}
+
 def format_attendance_daily(data: dict) -> str:
     lectures = data.get("lectures", [])
     headers  = data.get("headers", [])
@@ -951,26 +1439,20 @@ def format_attendance_daily(data: dict) -> str:
         lines.append(f"\U0001f393 {name} | {course} {sem}")
     lines.append("")
 
-    status_map = {
-        "P": "\u2705", "A": "\u274c", "H": "\U0001f3d6",
-        "S": "\u26d4", "L": "\U0001f4dd", "R": "\u23f3", "-": "\u2796"
-    }
-
     for lec in lectures:
         slot = lec.get("slot", "?")
         days = lec.get("days", [])
         lines.append(f"\U0001f4da *Lecture {slot}*")
 
-        present_count = sum(1 for d in days if d.get("status") == "P")
-        absent_count  = sum(1 for d in days if d.get("status") == "A")
-
+        present_count = absent_count = 0
         day_parts = []
         for d in days:
             st = d.get("status", "-")
-            date = d.get("date", "")
             if st == "-": continue
-            em = status_map.get(st, "\u2753")
-            day_parts.append(f"`{date}`{em}")
+            if st == "P": present_count += 1
+            elif st == "A": absent_count += 1
+            em = DAILY_STATUS_ICONS.get(st, "\u2753")
+            day_parts.append(f"`{d.get('date', '')}`{em}")
 
         for i in range(0, len(day_parts), 4):
             lines.append("  " + "  ".join(day_parts[i:i+4]))
@@ -979,7 +1461,7 @@ def format_attendance_daily(data: dict) -> str:
         lines.append("")
 
     lines += [
-        "\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501\u2501",
+        DIVIDER,
         "\u2705P=Present  \u274cA=Absent",
         "\U0001f3d6H=Holiday  \u26d4S=Suspended  \u23f3R=Remaining",
     ]
@@ -1011,12 +1493,13 @@ def format_exam_message(data: dict) -> str:
 
 # ================= AI ASSISTANT =================
 
+AI_TIMEOUT_SECONDS = 30  # overall budget for one assistant reply
+
 async def ask_erp_ai(question: str, context_data: dict) -> str:
     if not OPENAI_API_KEY:
         return "🤖 AI assistant not configured. Set OPENAI_API_KEY in .env to enable this feature."
 
     try:
-        import aiohttp
         context_str = json.dumps(context_data, indent=2)
         prompt = f"""You are an ERP assistant for a college student portal.
 Here is the student's current data:
@@ -1025,7 +1508,8 @@ Here is the student's current data:
 Answer this question concisely and helpfully:
 {question}"""
 
-        async with aiohttp.ClientSession() as session:
+        # Single-future bound: asyncio.timeout avoids the extra task/set bookkeeping of asyncio.wait_for.
+        async with asyncio.timeout(AI_TIMEOUT_SECONDS), http_session() as session:
             async with session.post(
                 "https://api.openai.com/v1/chat/completions",
                 headers={"Authorization": f"Bearer {OPENAI_API_KEY}"},
@@ -1037,47 +1521,76 @@ Answer this question concisely and helpfully:
             ) as resp:
                 result = await resp.json()
                 return result["choices"][0]["message"]["content"].strip()
+    except TimeoutError:
+        return "⌛ The AI assistant took too long to answer. Please try again."
     except Exception as e:
         return f"❌ AI error: {str(e)}"
 
 # ================= AUTO-LOGIN HELPER =================
 
+async def erp_login(page, username: str, password: str, use_cached: bool = False) -> bool:
+    """Log the page into the ERP. Returns True once it is on the student dashboard."""
+    async with browser_manager.semaphore, browser_manager.lean_loading(page):
+        restored = False
+        if use_cached:
+            try:
+                restored = await restore_login_state(page, username)
+            except Exception as e:
+                # A dead or half-loaded page must not cost the user their login; use the form instead.
+                logger.warning("Restoring cached login for %s failed: %s", username, e)
+                login_state_cache.pop(username, None)
+                try:
+                    await page.context.clear_cookies()
+                except Exception:
+                    pass
+        if not restored:
+            if not on_login_form(page):
+                await page.goto(ERP_LOGIN_URL, wait_until="domcontentloaded")
+            await page.locator(LOGIN_USERNAME_SELECTOR).fill(username)
+            await page.locator(LOGIN_PASSWORD_SELECTOR).fill(password)
+            await page.click(LOGIN_SUBMIT_SELECTOR)
+            try:
+                await page.locator(LOGIN_OUTCOME_SELECTOR).first.wait_for(timeout=10000)
+            except PlaywrightTimeoutError:
+                pass  # fall through to the URL check below
+
+    if "Home_student" not in page.url:
+        return False
+    if not restored:
+        await remember_login_state(page, username)
+    return True
+
 async def auto_login(chat_id: int) -> Optional[dict]:
     creds = get_credentials(chat_id)
     if not creds:
         return None
     username, password = creds
+    page = None
     try:
-        context = await browser_manager.new_context()
-        page = await context.new_page()
-        await page.goto("https://noble.icrp.in/academic/", wait_until="networkidle")
-        await page.type('input[name="txt_uname"]', username, delay=30)
-        await page.type('input[name="txt_password"]', password, delay=30)
-        await page.click('input[type="submit"]')
-        await page.wait_for_load_state("networkidle")
-
-        if "Home_student" not in page.url:
-            await context.close()
+        page = await browser_manager.acquire_page()
+        if not await erp_login(page, username, password, use_cached=True):
+            await browser_manager.release_page(page)
             return None
 
-        try:
-            await page.click("span[onclick='hide_popup();']", timeout=3000)
-        except Exception:
-            pass
-
-        session = {
-            "context": context,
-            "page": page,
-            "expires": datetime.now() + timedelta(minutes=SESSION_TIMEOUT_MINUTES),
-            "cache": {},
-        }
-        user_sessions[chat_id] = session
-        logger.info(f"Auto-login success for {chat_id}")
+        session = await open_session(chat_id, page)
+        logger.info("Auto-login success for %s", chat_id)
         return session
     except Exception as e:
-        logger.error(f"Auto-login failed for {chat_id}: {e}")
+        logger.error("Auto-login failed for %s: %s", chat_id, e)
+        if page:
+            await browser_manager.release_page(page)
         return None
 
+async def ensure_session(chat_id: int) -> Optional[dict]:
+    """Return the chat's live session, auto-logging in again if it is missing or expired."""
+    session = user_sessions.get(chat_id)
+    if not session or is_expired(session):
+        session = await auto_login(chat_id)
+    else:
+        refresh_session(chat_id)
+        await recycle_if_worn(session)
+    return session
+
 # ================= SCHEDULED ALERTS =================
 
 async def run_scheduled_alerts():
@@ -1087,14 +1600,13 @@ async def run_scheduled_alerts():
         users = get_all_users_with_alerts()
         for (chat_id, username, password) in users:
             try:
-                session = user_sessions.get(chat_id)
-                if not session or is_expired(session):
-                    session = await auto_login(chat_id)
+                session = await ensure_session(chat_id)
                 if not session:
                     continue
 
                 page = session["page"]
-                att_data = await extract_attendance(page)
+                async with browser_manager.lean_loading(page):
+                    att_data = await extract_attendance(page)
                 save_snapshot(chat_id, "attendance", att_data)
 
                 low = []
@@ -1112,10 +1624,17 @@ async def run_scheduled_alerts():
                     log_alert(chat_id, "attendance", msg)
 
             except Exception as e:
-                logger.error(f"Alert check failed for {chat_id}: {e}")
+                logger.error("Alert check failed for %s: %s", chat_id, e)
 
 # ================= BOT COMMANDS =================
 
+async def replace_message(old: Message, send):
+    """Delete ``old`` while ``send`` goes out. A failed delete is ignored; a failed send is raised."""
+    _, sent = await asyncio.gather(old.delete(), send, return_exceptions=True)
+    if isinstance(sent, Exception):
+        raise sent
+    return sent
+
 @dp.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     creds = get_credentials(message.chat.id)
@@ -1126,7 +1645,7 @@ async def cmd_start(message: Message, state: FSMContext):
         )
         session = await auto_login(message.chat.id)
         if session:
-            await message.answer("✅ Auto-login successful!", reply_markup=get_menu())
+            await message.answer("✅ Auto-login successful!", reply_markup=MAIN_MENU)
             return
         await message.answer("⚠️ Auto-login failed. Please re-enter credentials.")
 
@@ -1139,83 +1658,76 @@ async def cmd_start(message: Message, state: FSMContext):
 @dp.message(Command("menu"))
 async def cmd_menu(message: Message):
     chat_id = message.chat.id
-    session = user_sessions.get(chat_id)
-    if not session or is_expired(session):
-        session = await auto_login(chat_id)
+    session = await ensure_session(chat_id)
     if not session:
         await message.answer("❌ Not logged in. Use /start")
         return
     refresh_session(chat_id)
-    await message.answer("📱 Main Menu:", reply_markup=get_menu())
+    await message.answer("📱 Main Menu:", reply_markup=MAIN_MENU)
 
 @dp.message(Command("attendance"))
 async def cmd_attendance(message: Message):
     chat_id = message.chat.id
-    session = user_sessions.get(chat_id)
-    if not session or is_expired(session):
-        session = await auto_login(chat_id)
+    session = await ensure_session(chat_id)
     if not session:
         await message.answer("❌ Not logged in. Use /start")
         return
     msg = await message.answer("⏳ Fetching attendance data...")
-    att = await extract_attendance(session["page"])
+    async with browser_manager.lean_loading(session["page"]):
+        att = await extract_attendance(session["page"])
     save_snapshot(chat_id, "attendance", att)
     await msg.edit_text(format_attendance_message(att), parse_mode="Markdown")
 
 @dp.message(Command("fees"))
 async def cmd_fees(message: Message):
     chat_id = message.chat.id
-    session = user_sessions.get(chat_id)
-    if not session or is_expired(session):
-        session = await auto_login(chat_id)
+    session = await ensure_session(chat_id)
     if not session:
         await message.answer("❌ Not logged in. Use /start")
         return
     msg = await message.answer("⏳ Fetching fee data...")
-    fees = await extract_fees(session["page"])
+    async with browser_manager.lean_loading(session["page"]):
+        fees = await extract_fees(session["page"])
     save_snapshot(chat_id, "fees", fees)
     await msg.edit_text(format_fees_message(fees), parse_mode="Markdown")
 
 @dp.message(Command("exam"))
 async def cmd_exam(message: Message):
     chat_id = message.chat.id
-    session = user_sessions.get(chat_id)
-    if not session or is_expired(session):
-        session = await auto_login(chat_id)
+    session = await ensure_session(chat_id)
     if not session:
         await message.answer("❌ Not logged in. Use /start")
         return
     msg = await message.answer("⏳ Fetching exam results...")
-    exam = await extract_exam(session["page"])
+    async with browser_manager.lean_loading(session["page"]):
+        exam = await extract_exam(session["page"])
     save_snapshot(chat_id, "exam", exam)
     await msg.edit_text(format_exam_message(exam), parse_mode="Markdown")
 
 @dp.message(Command("profile"))
 async def cmd_profile(message: Message):
     chat_id = message.chat.id
-    session = user_sessions.get(chat_id)
-    if not session or is_expired(session):
-        session = await auto_login(chat_id)
+    session = await ensure_session(chat_id)
     if not session:
         await message.answer("❌ Not logged in. Use /start")
         return
     msg = await message.answer("⏳ Fetching your profile...")
-    profile_data = await extract_profile(session["page"])
+    async with browser_manager.lean_loading(session["page"]):
+        profile_data = await extract_profile(session["page"])
     save_snapshot(chat_id, "profile", profile_data)
     session.setdefault("cache", {})["profile"] = profile_data
-    await msg.edit_text(format_profile_message(profile_data), parse_mode="Markdown", reply_markup=get_back_menu())
+    await msg.edit_text(format_profile_message(profile_data), parse_mode="Markdown", reply_markup=BACK_MENU)
 
 @dp.message(Command("result"))
 async def cmd_result(message: Message):
     chat_id = message.chat.id
-    session = user_sessions.get(chat_id)
-    if not session or is_expired(session):
-        session = await auto_login(chat_id)
+    session = await ensure_session(chat_id)
     if not session:
         await message.answer("❌ Not logged in. Use /start")
         return
     msg = await message.answer("⏳ Fetching your results...")
-    result_data = await extract_result(session["page"])
+    async with browser_manager.lean_loading(session["page"]):
+        result_data = await extract_result(session["page"])
     save_snapshot(chat_id, "result", result_data)
     session.setdefault("cache", {})["result"] = result_data
     text = format_result_message(result_data)
@@ -1223,7 +1735,7 @@ async def cmd_result(message: Message):
         for i in range(0, len(text), 4000):
             await message.answer(text[i:i+4000], parse_mode="Markdown")
     else:
-        await msg.edit_text(text, parse_mode="Markdown", reply_markup=get_back_menu())
+        await msg.edit_text(text, parse_mode="Markdown", reply_markup=BACK_MENU)
 
 @dp.message(Command("status"))
 async def cmd_status(message: Message):
@@ -1252,7 +1764,7 @@ async def cmd_alerts(message: Message):
 
 @dp.message(Command("logout"))
 async def cmd_logout(message: Message):
-    await close_session(message.chat.id)
+    await close_session(message.chat.id, forget_login=True)
     await message.answer("🔓 Logged out. Your saved credentials remain for auto-login.\nUse /start to log in again.")
 
 # ================= LOGIN FLOW =================
@@ -1270,56 +1782,57 @@ async def get_password(message: Message, state: FSMContext):
     password = message.text.strip()
     await state.clear()
 
-    try:
-        await message.delete()
-    except Exception:
-        pass
-
-    msg = await message.answer("🔄 Logging in, please wait...")
+    # Drop the password from the chat and post the progress note at the same time.
+    msg = await replace_message(message, message.answer("🔄 Logging in, please wait..."))
+    await login_queue.put((message, msg, username, password))
 
+async def process_login(message: Message, msg: Message, username: str, password: str):
+    page = None
     try:
-        context = await browser_manager.new_context()
-        page = await context.new_page()
-
-        await page.goto("https://noble.icrp.in/academic/", wait_until="networkidle")
-        await page.type('input[name="txt_uname"]', username, delay=50)
-        await page.type('input[name="txt_password"]', password, delay=50)
-        await page.click('input[type="submit"]')
-        await page.wait_for_load_state("networkidle")
-
-        if "Home_student" not in page.url:
-            screenshot = await browser_manager.save_screenshot(page, "login_failed")
-            await message.answer_photo(FSInputFile(screenshot), caption="❌ Login Failed. Please try /start again.")
-            await context.close()
-            await msg.delete()
-            return
+        page = await browser_manager.acquire_page()
 
-        try:
-            await page.click("span[onclick='hide_popup();']", timeout=5000)
-        except Exception:
-            pass
+        if not await erp_login(page, username, password):
+            if DEBUG_SCREENSHOTS:
+                screenshot = await browser_manager.screenshot(page, "login_failed", full_page=False, reload_lean=False)
+                await replace_message(
+                    msg, message.answer_photo(screenshot, caption="❌ Login Failed. Please try /start again.")
+                )
+            else:
+                await msg.edit_text("❌ Login Failed. Please check your credentials and try /start again.")
+            await browser_manager.release_page(page)
+            return
 
         save_credentials(message.chat.id, username, password)
 
-        user_sessions[message.chat.id] = {
-            "context": context,
-            "page": page,
-            "expires": datetime.now() + timedelta(minutes=SESSION_TIMEOUT_MINUTES),
-            "cache": {},
-        }
+        await open_session(message.chat.id, page)
 
-        await msg.delete()
-        await message.answer(
+        await msg.edit_text(
             "✅ *Login Successful!*\n\n"
             "Tip: Use /profile, /result, /attendance, /fees for quick data, or the menu below.",
             parse_mode="Markdown",
-            reply_markup=get_menu(),
+            reply_markup=MAIN_MENU,
         )
 
     except Exception as e:
-        logger.error(f"Login error: {e}")
-        await msg.delete()
-        await message.answer(f"❌ Error: {str(e)}")
+        logger.error("Login error: %s", e)
+        if page and user_sessions.get(message.chat.id, {}).get("page") is not page:
+            await browser_manager.release_page(page)
+        await msg.edit_text(f"❌ Error: {str(e)}")
+
+# ================= LOGIN QUEUE =================
+
+# Password messages are acknowledged immediately; the browser work runs in these workers.
+login_queue: asyncio.Queue = asyncio.Queue()
+
+async def login_worker():
+    while True:
+        message, msg, username, password = await login_queue.get()
+        try:
+            await process_login(message, msg, username, password)
+        except Exception as e:
+            logger.error("Login worker error: %s", e)
+        finally:
+            login_queue.task_done()
 
 # ================= AI QUESTION FLOW =================
 
@@ -1329,9 +1842,7 @@ async def handle_ai_question(message: Message, state: FSMContext):
     await state.clear()
 
     chat_id = message.chat.id
-    session = user_sessions.get(chat_id)
-    if not session or is_expired(session):
-        session = await auto_login(chat_id)
+    session = await ensure_session(chat_id)
     if not session:
         await message.answer("❌ Session lost. Please /start again.")
         return
@@ -1339,53 +1850,82 @@ async def handle_ai_question(message: Message, state: FSMContext):
     msg = await message.answer("🤖 Fetching data & asking AI...")
 
     page = session["page"]
-    att  = await extract_attendance(page)
-    fees = await extract_fees(page)
-    exam = await extract_exam(page)
+    async with browser_manager.lean_loading(page):
+        att  = await extract_attendance(page)
+        fees = await extract_fees(page)
+        exam = await extract_exam(page)
     context_data = {"attendance": att, "fees": fees, "exam": exam}
 
     answer = await ask_erp_ai(question, context_data)
-    await msg.delete()
-    await message.answer(f"🤖 *AI Answer:*\n\n{answer}", parse_mode="Markdown", reply_markup=get_back_menu())
+    await replace_message(
+        msg, message.answer(f"🤖 *AI Answer:*\n\n{answer}", parse_mode="Markdown", reply_markup=BACK_MENU)
+    )
 
 # ================= CALLBACK HANDLER =================
 
+# chat_id -> callback data still being handled, so repeated taps on one button are dropped.
+callbacks_in_flight: Dict[int, set] = {}
+
 @dp.callback_query()
 async def menu_handler(callback: CallbackQuery, state: FSMContext):
+    chat_id = callback.message.chat.id
+    busy = callbacks_in_flight.setdefault(chat_id, set())
+    if callback.data in busy:
+        await callback.answer("⏳ Already loading…")
+        return
+    busy.add(callback.data)
+    try:
+        await handle_menu_action(callback, state)
+    finally:
+        busy.discard(callback.data)
+        if not busy:
+            callbacks_in_flight.pop(chat_id, None)
+
+async def handle_menu_action(callback: CallbackQuery, state: FSMContext):
     chat_id = callback.message.chat.id
     data = callback.data
 
     if data == "show_menu":
-        await callback.message.answer("📱 Main Menu:", reply_markup=get_menu())
+        await callback.message.answer("📱 Main Menu:", reply_markup=MAIN_MENU)
         await callback.answer()
         return
 
+    # A callback query can only be answered once; later calls would just be rejected API requests.
+    answered = False
+
+    async def ack(text: Optional[str] = None, **kwargs):
+        nonlocal answered
+        if not answered:
+            answered = True
+            await callback.answer(text, **kwargs)
+
     session = user_sessions.get(chat_id)
     if not session or is_expired(session):
-        await callback.answer("⏳ Restoring session...", show_alert=False)
+        await ack("⏳ Restoring session...", show_alert=False)
         session = await auto_login(chat_id)
         if not session:
             await callback.message.answer("❌ Session expired. Use /start to log in.")
-            await callback.answer()
+            await ack()
             return
 
-    if not await verify_logged_in(session["page"]):
-        await close_session(chat_id)
+    if not await verify_logged_in(session):
+        await ack("⏳ Restoring session...", show_alert=False)
+        await close_session(chat_id, forget_login=True)
         session = await auto_login(chat_id)
         if not session:
             await callback.message.answer("❌ Session lost. Use /start")
-            await callback.answer()
+            await ack()
             return
 
     refresh_session(chat_id)
+    await recycle_if_worn(session)
     page = session["page"]
 
     if data.startswith("page_"):
         idx = int(data.split("_")[1])
-        page_name = PAGE_KEYS[idx]
-        page_url  = PAGE_VALS[idx]
+        page_name, page_url = PAGE_ITEMS[idx]
 
-        await callback.answer(f"Loading {page_name}...")
+        await ack(f"Loading {page_name}...")
         loading = await callback.message.answer(f"⏳ Loading {page_name}...")
 
         # ── Profile ───────────────────────────────────────────
@@ -1394,17 +1934,14 @@ async def menu_handler(callback: CallbackQuery, state: FSMContext):
             save_snapshot(chat_id, "profile", profile_data)
             session.setdefault("cache", {})["profile"] = profile_data
 
-            screenshot = await browser_manager.save_screenshot(page, "profile")
-            await loading.delete()
-
-            await callback.message.answer_photo(
-                FSInputFile(screenshot),
-                caption="📸 Profile Page"
+            screenshot = await browser_manager.screenshot(page, "profile")
+            await replace_message(
+                loading, callback.message.answer_photo(screenshot, caption="📸 Profile Page")
             )
             await callback.message.answer(
                 format_profile_message(profile_data),
                 parse_mode="Markdown",
-                reply_markup=get_back_menu()
+                reply_markup=BACK_MENU
             )
 
         # ── Attendance ────────────────────────────────────────
@@ -1413,17 +1950,14 @@ async def menu_handler(callback: CallbackQuery, state: FSMContext):
             save_snapshot(chat_id, "attendance", att)
             session["cache"]["att"] = att
 
-            screenshot = await browser_manager.save_screenshot(page, "attendance")
-            await loading.delete()
-
-            await callback.message.answer_photo(
-                FSInputFile(screenshot),
-                caption="📸 Attendance Page"
+            screenshot = await browser_manager.screenshot(page, "attendance")
+            await replace_message(
+                loading, callback.message.answer_photo(screenshot, caption="📸 Attendance Page")
             )
             await callback.message.answer(
                 format_attendance_message(att),
                 parse_mode="Markdown",
-                reply_markup=get_attendance_menu()
+                reply_markup=ATTENDANCE_MENU
             )
 
         # ── Fees ──────────────────────────────────────────────
@@ -1432,17 +1966,14 @@ async def menu_handler(callback: CallbackQuery, state: FSMContext):
             save_snapshot(chat_id, "fees", fees)
             session["cache"]["fees"] = fees
 
-            screenshot = await browser_manager.save_screenshot(page, "fees")
-            await loading.delete()
-
-            await callback.message.answer_photo(
-                FSInputFile(screenshot),
-                caption="📸 Fee Details Page"
+            screenshot = await browser_manager.screenshot(page, "fees")
+            await replace_message(
+                loading, callback.message.answer_photo(screenshot, caption="📸 Fee Details Page")
             )
             await callback.message.answer(
                 format_fees_message(fees),
                 parse_mode="Markdown",
-                reply_markup=get_fees_menu()
+                reply_markup=FEES_MENU
             )
 
         # ── Exam ──────────────────────────────────────────────
@@ -1451,46 +1982,49 @@ async def menu_handler(callback: CallbackQuery, state: FSMContext):
             save_snapshot(chat_id, "exam", exam)
             session["cache"]["exam"] = exam
 
-            screenshot = await browser_manager.save_screenshot(page, "exam")
-            await loading.delete()
-
-            await callback.message.answer_photo(
-                FSInputFile(screenshot),
-                caption="📸 Exam Results Page"
+            screenshot = await browser_manager.screenshot(page, "exam")
+            await replace_message(
+                loading, callback.message.answer_photo(screenshot, caption="📸 Exam Results Page")
             )
             await callback.message.answer(
                 format_exam_message(exam),
                 parse_mode="Markdown",
-                reply_markup=get_back_menu()
+                reply_markup=BACK_MENU
             )
 
         # ── All other pages → screenshot only ────────────────
         else:
-            await page.goto(page_url, wait_until="networkidle")
-            screenshot = await browser_manager.save_screenshot(page, "page")
-            await loading.delete()
-            await callback.message.answer_photo(
-                FSInputFile(screenshot),
-                caption=f"📸 {page_name}",
-                reply_markup=get_back_menu()
+            # Telegram keeps uploaded photos, so a recent shot is re-sent by file_id.
+            shots = session["cache"].setdefault("shots", {})
+            cached = shots.get(page_url)
+            if cached and time.monotonic() - cached[1] < PAGE_SHOT_CACHE_SECONDS:
+                screenshot = cached[0]
+            else:
+                await browser_manager.show(page, page_url)
+                screenshot = await browser_manager.screenshot(page, "page")
+            sent = await replace_message(
+                loading, callback.message.answer_photo(screenshot, caption=f"📸 {page_name}", reply_markup=BACK_MENU)
             )
+            if not isinstance(screenshot, str) and sent.photo:
+                shots[page_url] = (sent.photo[-1].file_id, time.monotonic())
 
     elif data == "screenshot":
-        await callback.answer("Taking screenshot...")
-        screenshot = await browser_manager.save_screenshot(page, "manual")
-        await callback.message.answer_photo(FSInputFile(screenshot), caption="📸 Current Page", reply_markup=get_back_menu())
+        await ack("Taking screenshot...")
+        screenshot = await browser_manager.screenshot(page, "manual")
+        await callback.message.answer_photo(screenshot, caption="📸 Current Page", reply_markup=BACK_MENU)
 
     elif data == "smartdata":
-        await callback.answer("Extracting data...")
+        await ack("Extracting data...")
         loading = await callback.message.answer(
             "⏳ Extracting ERP data…\n"
             "_(Attendance, Fees, Exam & Profile)_",
             parse_mode="Markdown"
         )
-        att     = await extract_attendance(page)
-        fees    = await extract_fees(page)
-        exam    = await extract_exam(page)
-        profile = await extract_profile(page)
+        async with browser_manager.lean_loading(page):
+            att     = await extract_attendance(page)
+            fees    = await extract_fees(page)
+            exam    = await extract_exam(page)
+            profile = await extract_profile(page)
 
         save_snapshot(chat_id, "attendance", att)
         save_snapshot(chat_id, "fees", fees)
@@ -1505,28 +2039,29 @@ async def menu_handler(callback: CallbackQuery, state: FSMContext):
         await callback.message.answer(
             format_profile_message(profile),
             parse_mode="Markdown",
-            reply_markup=get_back_menu()
+            reply_markup=BACK_MENU
         )
         await callback.message.answer(
             format_attendance_message(att),
             parse_mode="Markdown",
-            reply_markup=get_attendance_menu()
+            reply_markup=ATTENDANCE_MENU
         )
         await callback.message.answer(
             format_fees_message(fees),
             parse_mode="Markdown",
-            reply_markup=get_fees_menu()
+            reply_markup=FEES_MENU
         )
         await callback.message.answer(
             format_exam_message(exam),
             parse_mode="Markdown",
-            reply_markup=get_back_menu()
+            reply_markup=BACK_MENU
         )
 
     elif data == "view_result":
-        await callback.answer("Fetching results...")
+        await ack("Fetching results...")
         loading = await callback.message.answer("⏳ Loading your exam results...")
-        result_data = await extract_result(page)
+        async with browser_manager.lean_loading(page):
+            result_data = await extract_result(page)
         save_snapshot(chat_id, "result", result_data)
         session.setdefault("cache", {})["result"] = result_data
         await loading.delete()
@@ -1535,14 +2070,15 @@ async def menu_handler(callback: CallbackQuery, state: FSMContext):
             for i in range(0, len(text), 4000):
                 await callback.message.answer(text[i:i+4000], parse_mode="Markdown")
         else:
-            await callback.message.answer(text, parse_mode="Markdown", reply_markup=get_back_menu())
+            await callback.message.answer(text, parse_mode="Markdown", reply_markup=BACK_MENU)
 
     elif data == "att_daily":
-        await callback.answer("Loading daily log...")
+        await ack("Loading daily log...")
         att = session.get("cache", {}).get("att")
         if not att:
             loading = await callback.message.answer("⏳ Fetching attendance...")
-            att = await extract_attendance(page)
+            async with browser_manager.lean_loading(page):
+                att = await extract_attendance(page)
             session.setdefault("cache", {})["att"] = att
             await loading.delete()
         daily_text = format_attendance_daily(att)
@@ -1550,24 +2086,25 @@ async def menu_handler(callback: CallbackQuery, state: FSMContext):
             for i in range(0, len(daily_text), 4000):
                 await callback.message.answer(daily_text[i:i+4000], parse_mode="Markdown")
         else:
-            await callback.message.answer(daily_text, parse_mode="Markdown", reply_markup=get_back_menu())
+            await callback.message.answer(daily_text, parse_mode="Markdown", reply_markup=BACK_MENU)
 
     elif data == "fees_detail":
-        await callback.answer("Loading transactions...")
+        await ack("Loading transactions...")
         fees = session.get("cache", {}).get("fees")
         if not fees:
             loading = await callback.message.answer("⏳ Fetching fees...")
-            fees = await extract_fees(page)
+            async with browser_manager.lean_loading(page):
+                fees = await extract_fees(page)
             session.setdefault("cache", {})["fees"] = fees
             await loading.delete()
         await callback.message.answer(
             format_fees_detail_message(fees),
             parse_mode="Markdown",
-            reply_markup=get_back_menu()
+            reply_markup=BACK_MENU
         )
 
     elif data == "ask_ai":
-        await callback.answer("Ask anything!")
+        await ack("Ask anything!")
         await state.set_state(AskStates.waiting_for_question)
         await callback.message.answer(
             "🤖 *Ask the AI anything about your ERP data!*\n\n"
@@ -1581,17 +2118,17 @@ async def menu_handler(callback: CallbackQuery, state: FSMContext):
     elif data == "toggle_alerts":
         new_state = toggle_alerts(chat_id)
         icon = "🔔" if new_state else "🔕"
-        await callback.answer(f"{icon} Alerts {'enabled' if new_state else 'disabled'}!", show_alert=True)
+        await ack(f"{icon} Alerts {'enabled' if new_state else 'disabled'}!", show_alert=True)
 
     elif data == "logout":
-        await close_session(chat_id)
+        await close_session(chat_id, forget_login=True)
         await callback.message.answer("🔓 Logged out. Credentials saved for next auto-login.")
         try:
             await callback.message.edit_reply_markup(reply_markup=None)
         except Exception:
             pass
 
-    await callback.answer()
+    await ack()  # no-op if a branch already answered
 
 # ================= HEALTH SERVER =================
 
@@ -1602,23 +2139,49 @@ async def health(request):
         text=json.dumps({"status": "ok", "active_sessions": active, "time": datetime.now().isoformat()})
     )
 
-async def start_health():
+health_runner: Optional[web.AppRunner] = None
+
+def build_web_app() -> web.Application:
+    """The process's only HTTP app: health routes, plus the Telegram webhook when enabled."""
     app = web.Application()
     app.router.add_get("/", health)
     app.router.add_get("/health", health)
-    runner = web.AppRunner(app)
-    await runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", PORT)
+    if WEBHOOK_URL:
+        SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+        setup_application(app, dp, bot=bot)
+    return app
+
+async def start_health():
+    global health_runner
+    health_runner = web.AppRunner(build_web_app())
+    await health_runner.setup()
+    site = web.TCPSite(health_runner, "0.0.0.0", PORT)
     await site.start()
-    logger.info(f"Health server running on port {PORT}")
+    logger.info("Health server running on port %s", PORT)
+
+async def stop_health():
+    if health_runner:
+        await health_runner.cleanup()
 
 # ================= STARTUP / SHUTDOWN =================
 
+background_tasks: List[asyncio.Task] = []
+
 async def on_startup():
     init_db()
     await browser_manager.start()
-    asyncio.create_task(start_health())
-    asyncio.create_task(run_scheduled_alerts())
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            allowed_updates=dp.resolve_used_update_types(),
+            drop_pending_updates=True,
+            secret_token=WEBHOOK_SECRET,
+        )
+    else:
+        await start_health()
+    background_tasks.append(asyncio.create_task(run_scheduled_alerts()))
+    background_tasks.append(asyncio.create_task(reap_idle_sessions()))
+    background_tasks.extend(asyncio.create_task(login_worker()) for _ in range(MAX_CONCURRENT_BROWSERS))
 
     await bot.set_my_commands([
         BotCommand(command="start",      description="Start / Auto-login"),
@@ -1635,27 +2198,58 @@ async def on_startup():
     logger.info("Bot started successfully")
 
 async def on_shutdown():
-    for chat_id in list(user_sessions.keys()):
-        await close_session(chat_id)
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await asyncio.gather(*(close_session(cid) for cid in list(user_sessions)), return_exceptions=True)
     await browser_manager.stop()
+    await stop_health()
+    await close_http()
+    await storage.close()
     logger.info("Bot shut down cleanly")
 
+async def run_webhook():
+    runner = web.AppRunner(build_web_app())
+    await runner.setup()
+    site = web.TCPSite(runner, "0.0.0.0", PORT)
+    await site.start()
+    logger.info("Webhook server running on port %s", PORT)
+    # Stop on SIGTERM/SIGINT so runner.cleanup() fires the shutdown hooks, as polling does.
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: Ctrl+C still arrives as KeyboardInterrupt
+    try:
+        await stop.wait()
+        logger.info("Stop signal received, shutting down webhook server")
+    finally:
+        await runner.cleanup()
+
 async def main():
     dp.startup.register(on_startup)
     dp.shutdown.register(on_shutdown)
 
+    if WEBHOOK_URL:
+        await run_webhook()
+        return
+
     logger.info("Clearing webhook and pending updates...")
     try:
         await bot.delete_webhook(drop_pending_updates=True)
     except Exception as e:
-        logger.warning(f"delete_webhook failed (non-fatal): {e}")
+        logger.warning("delete_webhook failed (non-fatal): %s", e)
 
     max_retries = 10
     for attempt in range(1, max_retries + 1):
         try:
-            logger.info(f"Starting polling (attempt {attempt}/{max_retries})...")
+            logger.info("Starting polling (attempt %s/%s)...", attempt, max_retries)
             await dp.start_polling(
                 bot,
+                handle_as_tasks=True,
                 allowed_updates=dp.resolve_used_update_types(),
                 drop_pending_updates=True,
             )
@@ -1665,15 +2259,24 @@ async def main():
             if "Conflict" in err or "terminated by other" in err:
                 wait = 5 * attempt
                 logger.warning(
-                    f"Conflict: another instance running. "
-                    f"Retrying in {wait}s ({attempt}/{max_retries})..."
+                    "Conflict: another instance running. "
+                    "Retrying in %ss (%s/%s)...",
+                    wait, attempt, max_retries,
                 )
                 await asyncio.sleep(wait)
             else:
-                logger.error(f"Fatal polling error: {e}")
+                logger.error("Fatal polling error: %s", e)
                 raise
     else:
         logger.error("Could not start polling after max retries.")
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop  # Optional: faster event loop where available
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
+    try:
+        run(main())
+    finally:
+        log_listener.stop()  # flush queued records before exit